@@ -1,7 +1,8 @@
 #app.py
+import concurrent.futures
 import os
-import subprocess
 import sys
+import threading
 import duckdb
 import pandas as pd
 import requests
@@ -17,6 +18,7 @@ import time
 # --- Paths ---
 REPO_ROOT = os.path.dirname(os.path.dirname(__file__))  # go up from /dashboard
 DB_PATH = os.path.join(REPO_ROOT, "data", "warehouse.duckdb")
+SCRAPER_DIR = os.path.join(REPO_ROOT, "scraper")  # where the scrapy project lives
 
 # --- Streamlit page config ---
 st.set_page_config(page_title="US Stocks Intel", layout="wide")
@@ -35,8 +37,11 @@ def get_secret(name: str, default: str | None = None):
         return default
 
 openai_api_key = get_secret("OPENAI_API_KEY")
-# openai.api_key = openai_api_key
-client = OpenAI(api_key=openai_api_key)
+
+@st.cache_resource
+def get_openai_client():
+    """One OpenAI client per server process so httpx reuses its pooled TLS connection."""
+    return OpenAI(api_key=openai_api_key, timeout=30, max_retries=2)
 
 if not openai_api_key:
     st.sidebar.warning(
@@ -45,102 +50,190 @@ if not openai_api_key:
     )
 
 # ---------- Helpers ----------
+@st.cache_resource
+def get_con():
+    """One DuckDB connection shared across reruns/sessions.
+
+    Opened read-write (not read-only) so the in-process spiders can write
+    through the same cached database instance; DuckDB refuses to open the
+    same file with mixed read-only/read-write configs in one process.
+
+    Readers call .cursor() on this rather than executing on it directly:
+    cursors share the cached database instance but keep their own result
+    state, so concurrent sessions can't fetch each other's result sets.
+    """
+    return duckdb.connect(DB_PATH)
+
+@st.cache_data(ttl=300, show_spinner=False)
 def load_ticker_list() -> list[str]:
     """Return distinct tickers we have in DuckDB (from either table)."""
     try:
-        con = duckdb.connect(DB_PATH, read_only=True)
-        df = con.execute("""
-            SELECT DISTINCT UPPER(ticker) AS t FROM (
-                SELECT ticker FROM sec_filings
-                UNION ALL
-                SELECT ticker FROM news
-            )
-            WHERE ticker IS NOT NULL AND ticker <> ''
-            ORDER BY t
-        """).df()
-        con.close()
-        items = df["t"].dropna().astype(str).tolist()
+        con = get_con().cursor()
+        try:
+            # tiny materialized list kept up to date by DuckDBPipeline
+            rows = con.execute("SELECT ticker FROM tickers ORDER BY ticker").fetchall()
+        except Exception:
+            # older warehouse without the tickers table: fall back to scanning both tables
+            rows = con.execute("""
+                SELECT DISTINCT UPPER(ticker) AS t FROM (
+                    SELECT ticker FROM sec_filings
+                    UNION ALL
+                    SELECT ticker FROM news
+                )
+                WHERE ticker IS NOT NULL AND ticker <> ''
+                ORDER BY t
+            """).fetchall()
+        items = [r[0] for r in rows if r[0]]
         return sorted(set(items + ["AAPL", "MSFT", "NVDA", "AMZN", "GOOGL"]))  # ensure some defaults
     except Exception:
         return ["AAPL", "MSFT", "NVDA", "AMZN", "GOOGL"]
 
-def run_spider(spider: str, ticker: str, item_limit: int = 30, cwd: str = None) -> tuple[bool, str]:
+@st.cache_resource
+def get_reactor():
+    """Start the Twisted reactor once in a daemon thread.
+
+    The reactor is not restartable, so it has to outlive Streamlit reruns;
+    st.cache_resource keeps it for the life of the server process. The
+    asyncio reactor is installed explicitly to match the project's
+    TWISTED_REACTOR setting, which CrawlerRunner verifies.
     """
-    Run a Scrapy spider in-process env using the current Python (virtualenv-safe).
-    Adjust 'cwd' to the folder where scrapy.cfg lives (your repo root or scraper/).
+    from scrapy.utils.reactor import install_reactor
+    install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+    from twisted.internet import reactor
+    t = threading.Thread(target=lambda: reactor.run(installSignalHandlers=False), daemon=True)
+    t.start()
+    return reactor
+
+@st.cache_resource
+def get_scrape_executor():
+    """Worker pool that runs scrapes without blocking the Streamlit script thread."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="scrapy")
+
+def run_spiders(ticker: str, item_limit: int = 30, timeout: int = 600) -> tuple[bool, str]:
     """
-    env = os.environ.copy()
-    # throttle costs a bit
-    cmd = [
-        sys.executable, "-m", "scrapy", "crawl", spider,
-        "-a", f"ticker={ticker}",
-        "-s", f"CLOSESPIDER_ITEMCOUNT={item_limit}",
-        "-s", "AUTOTHROTTLE_ENABLED=True",
-        "-s", "CONCURRENT_REQUESTS=8",
-        "-s", "DOWNLOAD_DELAY=0.5",
-    ]
-    try:
-        res = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, check=False, timeout=600)
-        ok = (res.returncode == 0)
-        log = (res.stdout or "") + "\n" + (res.stderr or "")
-        return ok, log
-    except Exception as e:
-        return False, f"Failed to run spider {spider}: {e}"
+    Crawl both spiders concurrently in-process on the shared reactor.
+    Avoids forking a fresh interpreter (plus Scrapy import cost) per spider
+    and lets the two crawls overlap instead of running back to back.
+    """
+    if SCRAPER_DIR not in sys.path:
+        sys.path.insert(0, SCRAPER_DIR)
+    os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "stockscraper.settings")
+    from scrapy.crawler import CrawlerRunner
+    from scrapy.utils.project import get_project_settings
+    from twisted.internet import defer
+
+    settings = get_project_settings()
+    # concurrency/throttle tuning lives in stockscraper.settings; only the
+    # per-run item cap is overridden here
+    settings.set("CLOSESPIDER_ITEMCOUNT", item_limit)
+
+    reactor = get_reactor()
+    done = threading.Event()
+    outcome = {}
+
+    def _start():
+        try:
+            runner = CrawlerRunner(settings)
+            d = defer.DeferredList([
+                runner.crawl("sec_filings", ticker=ticker),
+                runner.crawl("yahoo_news_rss", ticker=ticker),
+            ], consumeErrors=True)
+            def _finish(results):
+                outcome["results"] = results
+                done.set()
+            d.addBoth(_finish)
+        except Exception as e:
+            outcome["error"] = str(e)
+            done.set()
+
+    reactor.callFromThread(_start)
+    if not done.wait(timeout):
+        return False, f"Spider run timed out after {timeout}s"
+    if "error" in outcome:
+        return False, f"Failed to start spiders: {outcome['error']}"
+
+    lines, ok = [], True
+    for name, (success, value) in zip(["sec_filings", "yahoo_news_rss"], outcome["results"]):
+        if success:
+            lines.append(f"{name}: finished")
+        else:
+            ok = False
+            lines.append(f"{name}: failed — {value}")
+    return ok, "\n".join(lines)
 
+@st.cache_data(ttl=300, show_spinner=False)
 def fetch_db(ticker: str):
     try:
-        con = duckdb.connect(DB_PATH, read_only=True)
+        con = get_con().cursor()
+        # cast in SQL so no pandas coercion pass is needed afterwards;
+        # .arrow() + ArrowDtype skips the full DuckDB->pandas copy of .df()
         sec_df = con.execute("""
-            SELECT form, filing_date, report_url, summary_ai, sentiment, sentiment_score
+            SELECT form, CAST(filing_date AS DATE) AS filing_date, report_url,
+                   summary_ai, sentiment, CAST(sentiment_score AS DOUBLE) AS sentiment_score
             FROM sec_filings WHERE ticker = ? ORDER BY filing_date DESC LIMIT 50
-        """, [ticker]).df()
+        """, [ticker]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
         news_df = con.execute("""
-            SELECT published, title, link, summary_ai, sentiment, sentiment_score
+            SELECT CAST(published AS TIMESTAMP) AS published, title, link,
+                   summary_ai, sentiment, CAST(sentiment_score AS DOUBLE) AS sentiment_score
             FROM news WHERE ticker = ? ORDER BY published DESC NULLS LAST LIMIT 200
-        """, [ticker]).df()
-        con.close()
+        """, [ticker]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
     except Exception as e:
         st.error(f"Database error: {e}")
         sec_df, news_df = pd.DataFrame(), pd.DataFrame()
-
-    # coerce
-    if not sec_df.empty:
-        sec_df["filing_date"] = pd.to_datetime(sec_df["filing_date"], errors="coerce")
-        sec_df["sentiment_score"] = pd.to_numeric(sec_df["sentiment_score"], errors="coerce")
-    if not news_df.empty:
-        news_df["published"] = pd.to_datetime(news_df["published"], errors="coerce")
-        news_df["sentiment_score"] = pd.to_numeric(news_df["sentiment_score"], errors="coerce")
     return sec_df, news_df
 
-def build_unified(sec_df, news_df):
-    parts = []
-    if sec_df is not None and not sec_df.empty:
-        a = sec_df.copy()
-        a["kind"] = "FILING"
-        a["when"] = pd.to_datetime(a["filing_date"], errors="coerce")
-        a["title_disp"] = a["form"].fillna("Filing")
-        a["url"] = a["report_url"]
-        a["summary_disp"] = a["summary_ai"]
-        parts.append(a[["kind","when","title_disp","url","summary_disp","sentiment","sentiment_score"]])
-    if news_df is not None and not news_df.empty:
-        b = news_df.copy()
-        b["kind"] = "NEWS"
-        b["when"] = pd.to_datetime(b["published"], errors="coerce")
-        b["title_disp"] = b["title"].fillna("News")
-        b["url"] = b["link"]
-        b["summary_disp"] = b["summary_ai"]
-        parts.append(b[["kind","when","title_disp","url","summary_disp","sentiment","sentiment_score"]])
-    if not parts:
-        return pd.DataFrame(columns=["kind","when","title_disp","url","summary_disp","sentiment","sentiment_score"])
-    out = pd.concat(parts, ignore_index=True)
-    out["sentiment_score"] = pd.to_numeric(out["sentiment_score"], errors="coerce")
-    return out.dropna(subset=["sentiment_score"])
-
-def fmt_summary(text, max_len=120):
-    s = "" if text is None else str(text)
-    return s if len(s) <= max_len else s[:max_len] + "…"
-
-@st.cache_data(ttl=900, show_spinner=False)
+@st.cache_data(ttl=300, show_spinner=False)
+def get_extremes(ticker: str):
+    """Most positive / most negative row across filings + news, picked in DuckDB.
+
+    Two ORDER BY ... LIMIT 1 queries instead of concatenating both tables
+    into pandas and sorting twice.
+    """
+    base = """
+        SELECT * FROM (
+            SELECT 'FILING' AS kind, form AS title_disp, report_url AS url,
+                   summary_ai AS summary_disp, sentiment,
+                   CAST(sentiment_score AS DOUBLE) AS sentiment_score,
+                   CAST(filing_date AS TIMESTAMP) AS "when"
+            FROM sec_filings WHERE ticker = ? AND sentiment_score IS NOT NULL
+            UNION ALL
+            SELECT 'NEWS', title, link, summary_ai, sentiment,
+                   CAST(sentiment_score AS DOUBLE),
+                   CAST(published AS TIMESTAMP)
+            FROM news WHERE ticker = ? AND sentiment_score IS NOT NULL
+        )
+        ORDER BY sentiment_score {direction}, "when" DESC NULLS LAST LIMIT 1
+    """
+    try:
+        con = get_con().cursor()
+        max_df = con.execute(base.format(direction="DESC"), [ticker, ticker]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
+        min_df = con.execute(base.format(direction="ASC"), [ticker, ticker]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
+    except Exception as e:
+        st.error(f"Database error: {e}")
+        return None, None
+    max_row = max_df.iloc[0] if not max_df.empty else None
+    min_row = min_df.iloc[0] if not min_df.empty else None
+    return max_row, min_row
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_sentiment_timeseries(ticker: str) -> pd.Series:
+    """5-item rolling mean of news sentiment, smoothed by a DuckDB window function."""
+    try:
+        df = get_con().cursor().execute("""
+            SELECT CAST(published AS TIMESTAMP) AS published,
+                   AVG(sentiment_score) OVER (
+                       ORDER BY published ROWS BETWEEN 4 PRECEDING AND CURRENT ROW
+                   ) AS smoothed
+            FROM news
+            WHERE ticker = ? AND sentiment_score IS NOT NULL AND published IS NOT NULL
+            ORDER BY published
+        """, [ticker]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
+    except Exception as e:
+        st.error(f"Database error: {e}")
+        return pd.Series(dtype="float64")
+    return df.set_index("published")["smoothed"]
+
+@st.cache_data(ttl=300, show_spinner=False)
 def safe_download_price(ticker: str, period: str, interval: str) -> pd.DataFrame:
     """
     Try Yahoo Finance first (with real UA + retries). If it fails/returns empty,
@@ -232,23 +325,39 @@ item_limit = st.sidebar.slider("Scrape max items (per spider)", 5, 100, 25, step
 # 2) generate button
 generate_clicked = st.sidebar.button("⚡ Generate latest data")
 # ---------- Run spiders on demand ----------
+# The scrape runs on a worker thread and is polled via st.session_state, so
+# the charts and tables below keep rendering while it is in flight.
 if generate_clicked:
-    st.sidebar.info(f"Running spiders for {ticker} (limit {item_limit})…")
-    # set cwd to your scrapy project root (where scrapy.cfg lives)
-    SCRAPY_CWD = os.path.abspath(os.path.join(os.path.dirname(__file__), "../scraper"))
-    with st.status("Scraping in progress…", expanded=True) as status:
-        ok1, log1 = run_spider("sec_filings", ticker, item_limit=item_limit, cwd=SCRAPY_CWD)
-        st.write("SEC filings spider finished." if ok1 else "SEC filings spider failed.")
-        st.code(log1[-4000:])  # tail logs
-
-        ok2, log2 = run_spider("yahoo_news_rss", ticker, item_limit=item_limit, cwd=SCRAPY_CWD)
-        st.write("Yahoo News spider finished." if ok2 else "Yahoo News spider failed.")
-        st.code(log2[-4000:])
-
-        if ok1 or ok2:
-            status.update(label="Scraping done. Reloading data…", state="complete")
-        else:
-            status.update(label="Scraping failed.", state="error")
+    running = "scrape_future" in st.session_state and not st.session_state.scrape_future.done()
+    if running:
+        st.sidebar.warning("A scrape is already running.")
+    else:
+        st.session_state.scrape_future = get_scrape_executor().submit(
+            run_spiders, ticker, item_limit=item_limit
+        )
+        st.sidebar.info(f"Running spiders for {ticker} (limit {item_limit})…")
+
+scrape_future = st.session_state.get("scrape_future")
+if scrape_future is not None and scrape_future.done():
+    try:
+        ok, log = scrape_future.result()
+    except Exception as e:
+        ok, log = False, f"Spider run crashed: {e}"
+    del st.session_state["scrape_future"]
+    st.session_state.scrape_result = (ok, log)
+    if ok:
+        # drop cached query results so the new rows show up
+        st.cache_data.clear()
+    st.rerun()
+
+if "scrape_result" in st.session_state:
+    ok, log = st.session_state.scrape_result
+    if ok:
+        st.sidebar.success("Scraping done. Data reloaded.")
+    else:
+        st.sidebar.error("Spider run failed.")
+    with st.sidebar.expander("Scrape log"):
+        st.code(log[-4000:])  # tail logs
 
 # ---------- Price chart ----------
 st.subheader(f"Price – {ticker}")
@@ -264,11 +373,9 @@ else:
 # ---------- Load & show data ----------
 sec_df, news_df = fetch_db(ticker)
 
-combined = build_unified(sec_df, news_df)
-if not combined.empty:
+max_row, min_row = get_extremes(ticker)
+if max_row is not None and min_row is not None:
     st.subheader("Most Extreme Sentiments (Filings + News)")
-    max_row = combined.sort_values(by=["sentiment_score","when"], ascending=[False, False]).iloc[0]
-    min_row = combined.sort_values(by=["sentiment_score","when"], ascending=[True, False]).iloc[0]
     c1, c2 = st.columns(2)
     with c1:
         st.success("📈 Most Positive")
@@ -294,23 +401,35 @@ with col1:
         st.info("No filings yet. Run the SEC spider.")
     else:
         st.write("**All Recent Filings**")
-        for _, row in sec_df.iterrows():
-            score = row.get("sentiment_score")
-            if pd.notna(score):
-                color = "🟢" if float(score) > 0.1 else ("🔴" if float(score) < -0.1 else "🟡")
-                text = f"{color} {row.get('sentiment','Unknown')} ({float(score):.2f})"
-            else:
-                text = f"⚪ {row.get('sentiment','Unknown')}"
+        # build the display columns in one vectorized pass, then just emit widgets
+        score = sec_df["sentiment_score"].astype("float64")
+        sentiment = sec_df["sentiment"].fillna("Unknown").astype(str)
+        # wrap in a Series: numpy < 2.0 can't `+` unicode ndarrays, so the
+        # badge concatenation below has to go through pandas
+        color = pd.Series(np.select([score > 0.1, score < -0.1], ["🟢", "🔴"], default="🟡"), index=sec_df.index)
+        summary = sec_df["summary_ai"].astype("string").fillna("")
+        disp = pd.DataFrame({
+            "form": sec_df["form"].fillna("N/A").astype(str),
+            "date_str": pd.to_datetime(sec_df["filing_date"], errors="coerce").dt.strftime("%Y-%m-%d").fillna("N/A"),
+            "summary_short": summary.str.slice(0, 120) + np.where(summary.str.len().gt(120), "…", ""),
+            "badge": np.where(
+                score.notna(),
+                color + " " + sentiment + " (" + score.map("{:.2f}".format) + ")",
+                "⚪ " + sentiment,
+            ),
+            "report_url": sec_df["report_url"],
+            "has_url": sec_df["report_url"].notna(),
+        })
+        for row in disp.itertuples(index=False):
             with st.container():
                 cL, cR = st.columns([3,1])
                 with cL:
-                    date_str = row["filing_date"].strftime("%Y-%m-%d") if pd.notna(row.get("filing_date")) else "N/A"
-                    st.markdown(f"**{row.get('form','N/A')}** — {date_str}")
-                    st.caption(fmt_summary(row.get("summary_ai")))
+                    st.markdown(f"**{row.form}** — {row.date_str}")
+                    st.caption(row.summary_short)
                 with cR:
-                    st.markdown(text)
-                    if pd.notna(row.get("report_url", None)):
-                        st.markdown(f"[📄 View]({row['report_url']})")
+                    st.markdown(row.badge)
+                    if row.has_url:
+                        st.markdown(f"[📄 View]({row.report_url})")
                 st.markdown("---")
 
 with col2:
@@ -318,28 +437,30 @@ with col2:
     if news_df.empty:
         st.info("No news yet. Run the RSS spider.")
     else:
-        for _, row in news_df.iterrows():
-            title = str(row.get("title","Untitled"))
-            link = row.get("link")
-            st.markdown(f"**{title}**" + (f" — [Link]({link})" if pd.notna(link) else ""))
+        # same idea as the filings column: vectorize the formatting, loop only to emit widgets
+        score = news_df["sentiment_score"].astype("float64")
+        sentiment = news_df["sentiment"].fillna("Unknown").astype(str)
+        disp = pd.DataFrame({
+            "headline": "**" + news_df["title"].fillna("Untitled").astype(str) + "**"
+                        + np.where(news_df["link"].notna(), " — [Link](" + news_df["link"].astype(str) + ")", ""),
+            "summary_ai": news_df["summary_ai"].fillna(""),
+            "sentiment_line": np.where(
+                score.notna(),
+                "**Sentiment:** " + sentiment + " (" + score.map("{:.2f}".format) + ")",
+                "**Sentiment:** " + sentiment,
+            ),
+        })
+        for row in disp.itertuples(index=False):
+            st.markdown(row.headline)
             with st.expander("AI Summary"):
-                st.write(row.get("summary_ai") or "No summary available.")
-                s = row.get("sentiment_score")
-                if pd.isna(s):
-                    st.write(f"**Sentiment:** {row.get('sentiment','Unknown')}")
-                else:
-                    st.write(f"**Sentiment:** {row.get('sentiment','Unknown')} ({float(s):.2f})")
+                st.write(row.summary_ai or "No summary available.")
+                st.write(row.sentiment_line)
 
 # ---------- Sentiment over time ----------
 st.subheader("News Sentiment Over Time")
-if not news_df.empty and "published" in news_df.columns and "sentiment_score" in news_df.columns:
-    s = pd.to_numeric(news_df["sentiment_score"], errors="coerce")
-    t = pd.to_datetime(news_df["published"], errors="coerce")
-    ts = pd.Series(s.values, index=t).dropna().rolling(window=5, min_periods=1).mean()
-    if not ts.empty:
-        st.line_chart(ts)
-    else:
-        st.info("No sentiment data available for chart.")
+ts = get_sentiment_timeseries(ticker)
+if not ts.empty:
+    st.line_chart(ts)
 else:
     st.info("No news with sentiment scores to analyse.")
 
@@ -355,7 +476,8 @@ else:
             # titles
             titles = "No recent news available"
             if not news_df.empty and "title" in news_df.columns:
-                titles_list = news_df["title"].astype(str).replace("nan","").fillna("").head(10).tolist()
+                # slice first so the string cleanup only touches 10 rows
+                titles_list = news_df["title"].head(10).astype(str).replace("nan","").fillna("").tolist()
                 titles_list = [t for t in (t.strip() for t in titles_list) if t]
                 titles = "\n".join(f"- {t}" for t in titles_list) or "No recent news available"
 
@@ -368,7 +490,9 @@ else:
             # price change
             price_change_str = "N/A"
             if not price.empty and "Close" in price.columns and price["Close"].shape[0] >= 2:
-                pct = float(price["Close"].pct_change().iloc[-1])
+                # scalar math on the last two closes; no pct_change Series allocation
+                closes = price["Close"].to_numpy().ravel()
+                pct = float(closes[-1] / closes[-2] - 1.0)
                 if pd.notna(pct):
                     price_change_str = f"{pct * 100:.2f}%"
 
@@ -381,7 +505,7 @@ else:
                 f"Last Price Change: {price_change_str}\n\n"
                 "Generate the insights now."
             )
-            resp = client.chat.completions.create(
+            resp = get_openai_client().chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.5,
@@ -389,3 +513,10 @@ else:
             st.markdown(str(resp.choices[0].message.content))
         except Exception as e:
             st.error(f"Failed to generate AI insights: {e}")
+
+# ---------- Background scrape polling ----------
+# Placed last so the whole page has rendered before we sleep and rerun.
+if "scrape_future" in st.session_state and not st.session_state.scrape_future.done():
+    st.sidebar.info("Scraping in progress…")
+    time.sleep(2)
+    st.rerun()
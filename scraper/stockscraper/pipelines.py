@@ -1,11 +1,12 @@
 # scraper/stockscraper/pipelines.py
 import os
 import duckdb
-import pandas as pd
 from datetime import datetime
+import hashlib
 import openai
 import json
 from scrapy.exceptions import DropItem
+from twisted.internet import defer
 from dotenv import load_dotenv
 from itemadapter import ItemAdapter
 import logging
@@ -21,6 +22,23 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 if not openai.api_key:
     logger.warning("OPENAI_API_KEY environment variable not set. AI pipeline will be skipped.")
 
+# Truncate prompts by tokens rather than characters: OpenAI cost and latency
+# are per-token, and 1000 chars over- or under-shoots depending on the text.
+try:
+    import tiktoken
+    _ENCODER = tiktoken.encoding_for_model("gpt-4o-mini")
+except Exception:
+    _ENCODER = None  # tiktoken missing or its BPE file unavailable
+
+TOKEN_BUDGET = 600
+CHAR_BUDGET = 1000
+
+def clip_text(text: str) -> str:
+    """Cap text at the prompt budget (tokens if tiktoken is available, else chars)."""
+    if _ENCODER is not None:
+        return _ENCODER.decode(_ENCODER.encode(text)[:TOKEN_BUDGET])
+    return text[:CHAR_BUDGET]
+
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../data"))
 LAKE_DIR = os.path.join(DATA_DIR, "lake")
 DB_PATH = os.path.join(DATA_DIR, "warehouse.duckdb")
@@ -31,20 +49,61 @@ logger.info(f"Data directory: {DATA_DIR}")
 logger.info(f"Database path: {DB_PATH}")
 
 class OpenAIPipeline:
+    # One API call analyzes up to BATCH_SIZE items, so wall-clock is ~1 RTT
+    # per batch instead of 1 RTT per item. Partial batches flush on a timer:
+    # buffered items hold a pending Deferred, which keeps the scraper slot
+    # busy, so spider_idle would never fire to release them — the timer is
+    # the only safe trigger.
+    BATCH_SIZE = 10
+    FLUSH_DELAY = 2.0  # seconds without a new item before a partial batch goes out
+
     def open_spider(self, spider):
         logger.info("OpenAI Pipeline opened")
+        self.buf = []  # (deferred, item, text, hash) waiting for the next batched call
+        self._flush_call = None  # pending reactor.callLater for a partial batch
+        # one client for the whole run so httpx keeps a pooled keep-alive
+        # TLS connection instead of handshaking per request
+        self.client = openai.OpenAI(api_key=openai.api_key, timeout=30, max_retries=2) if openai.api_key else None
+        # persistent analysis cache so re-scraped filings/news don't pay token cost again
+        self.con = duckdb.connect(DB_PATH)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS ai_cache (
+          h VARCHAR PRIMARY KEY,
+          summary TEXT,
+          sentiment VARCHAR,
+          sentiment_score DOUBLE
+        );
+        """)
 
     def process_item(self, item, spider):
         logger.info(f"OpenAI Pipeline processing item: {type(item).__name__}")
-        
+
+        adapter = ItemAdapter(item)
+
+        # re-scraped items are already analyzed and stored; drop them before
+        # they cost an API call (the DB insert would be skipped anyway)
+        try:
+            if adapter.get("accession_no"):
+                seen = self.con.execute(
+                    "SELECT 1 FROM sec_filings WHERE accession_no = ?", [adapter["accession_no"]]
+                ).fetchone()
+            elif adapter.get("link"):
+                seen = self.con.execute(
+                    "SELECT 1 FROM news WHERE link = ?", [adapter["link"]]
+                ).fetchone()
+            else:
+                seen = None
+        except Exception:
+            seen = None  # fresh warehouse: tables don't exist yet
+        if seen:
+            raise DropItem(f"Already stored: {adapter.get('accession_no') or adapter.get('link')}")
+
         if not openai.api_key:
             logger.info("Skipping OpenAI processing - no API key")
             return item
-
-        adapter = ItemAdapter(item)
         text_content = (
             adapter.get("report_text")
-            or adapter.get("article_text") 
+            or adapter.get("article_text")
             or f"{adapter.get('title', '')} — {adapter.get('summary', '')}"
         )
 
@@ -52,224 +111,246 @@ class OpenAIPipeline:
             logger.info("No meaningful text content found, skipping AI analysis")
             return item
 
+        text_content = clip_text(text_content)
+        h = hashlib.sha256(text_content.encode()).hexdigest()
+        cached = self.con.execute(
+            "SELECT summary, sentiment, sentiment_score FROM ai_cache WHERE h = ?", [h]
+        ).fetchone()
+        if cached:
+            logger.info("AI cache hit, skipping OpenAI call")
+            adapter["summary_ai"] = cached[0]
+            adapter["sentiment"] = cached[1]
+            adapter["sentiment_score"] = cached[2]
+            return item
+
+        # buffer the item; the returned Deferred fires once its batch is analyzed,
+        # so downstream pipelines still see fully-populated items
+        d = defer.Deferred()
+        self.buf.append((d, item, text_content, h))
+        if len(self.buf) >= self.BATCH_SIZE:
+            self._flush()
+        else:
+            self._schedule_flush()
+        return d
+
+    def _schedule_flush(self):
+        # imported lazily so this module never installs the default reactor
+        # before the app has had a chance to install the asyncio one
+        from twisted.internet import reactor
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.reset(self.FLUSH_DELAY)
+        else:
+            self._flush_call = reactor.callLater(self.FLUSH_DELAY, self._flush)
+
+    def _flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        if not self.buf:
+            return
+        batch, self.buf = self.buf, []
+        logger.info(f"Calling OpenAI API for a batch of {len(batch)} items...")
+
+        numbered = "\n\n".join(
+            f"Text {i + 1}: \"{text}\"" for i, (_, _, text, _) in enumerate(batch)
+        )
+        results = []
         try:
-            logger.info("Calling OpenAI API...")
-            response = openai.chat.completions.create(
+            response = self.client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
-                    {"role": "system", "content": "You are a financial analyst. Analyze the following text."},
+                    {"role": "system", "content": "You are a financial analyst. Analyze the following texts."},
                     {"role": "user", "content": f"""
-                        From the text below, provide these three things in a JSON format with keys "summary", "sentiment", and "sentiment_score":
+                        For each of the {len(batch)} numbered texts below, provide three things:
                         1. A concise one-sentence summary.
                         2. The overall sentiment (options: Positive, Negative, Neutral).
                         3. A sentiment score from -1.0 (very negative) to 1.0 (very positive).
 
-                        Text: "{text_content[:1000]}"
+                        Respond in JSON format with a single key "results" holding an array of
+                        {len(batch)} objects (in the same order as the texts), each with keys
+                        "summary", "sentiment", and "sentiment_score".
+
+                        {numbered}
                     """}
                 ],
                 response_format={"type": "json_object"},
                 temperature=0.2,
             )
-            
-            analysis = json.loads(response.choices[0].message.content)
-            adapter["summary_ai"] = analysis.get("summary", "")
-            adapter["sentiment"] = analysis.get("sentiment", "Unknown")
-            adapter["sentiment_score"] = float(analysis.get("sentiment_score", 0.0))
-            logger.info("OpenAI analysis completed successfully")
-
+            results = json.loads(response.choices[0].message.content).get("results", [])
+            logger.info(f"OpenAI batch analysis completed for {len(results)} items")
         except Exception as e:
             logger.error(f"OpenAI API call failed: {e}")
-            adapter["summary_ai"] = "Error in analysis."
-            adapter["sentiment"] = "Unknown"
-            adapter["sentiment_score"] = 0.0
-            
-        return item
+
+        for i, (d, item, _, h) in enumerate(batch):
+            adapter = ItemAdapter(item)
+            analysis = results[i] if i < len(results) else None
+            if analysis is not None:
+                adapter["summary_ai"] = analysis.get("summary", "")
+                adapter["sentiment"] = analysis.get("sentiment", "Unknown")
+                try:
+                    adapter["sentiment_score"] = float(analysis.get("sentiment_score", 0.0))
+                except (TypeError, ValueError):
+                    adapter["sentiment_score"] = 0.0
+                self.con.execute(
+                    "INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?, ?)",
+                    [h, adapter["summary_ai"], adapter["sentiment"], adapter["sentiment_score"]],
+                )
+            else:
+                # don't cache failures; a later run should retry
+                adapter["summary_ai"] = "Error in analysis."
+                adapter["sentiment"] = "Unknown"
+                adapter["sentiment_score"] = 0.0
+            d.callback(item)
 
     def close_spider(self, spider):
+        # normally the timer has already drained the buffer; on a forced
+        # shutdown fire any leftovers so their Deferreds can't hang close
+        self._flush()
+        try:
+            self.con.close()
+        except Exception as e:
+            logger.error(f"Error closing ai_cache connection: {e}")
         logger.info("OpenAI Pipeline closed")
 
 
 class DuckDBPipeline:
-    def __init__(self):
-        self.items = []
+    # Fixed column order shared by the streaming INSERTs below
+    SEC_COLUMNS = [
+        "cik", "ticker", "company_name", "form", "filing_date",
+        "accession_no", "primary_doc", "report_url", "report_text",
+        "summary_ai", "sentiment", "sentiment_score",
+    ]
+    NEWS_COLUMNS = [
+        "ticker", "source", "title", "link", "published",
+        "summary", "article_text", "summary_ai", "sentiment", "sentiment_score",
+    ]
+    SEC_DEFAULTS = {
+        "cik": "", "ticker": "", "company_name": "", "form": "",
+        "accession_no": "", "primary_doc": "", "report_url": "",
+        "report_text": "", "summary_ai": "", "sentiment": "Unknown",
+        "sentiment_score": 0.0,
+    }
+    NEWS_DEFAULTS = {
+        "ticker": "", "source": "", "title": "", "link": "",
+        "summary": "", "article_text": "", "summary_ai": "",
+        "sentiment": "Unknown", "sentiment_score": 0.0,
+    }
 
     def open_spider(self, spider):
         logger.info("DuckDB Pipeline opened")
         try:
-            # Test database connection
             self.con = duckdb.connect(DB_PATH)
-            
+
             # Create tables with explicit schemas
             self.con.execute("""
             CREATE TABLE IF NOT EXISTS sec_filings (
-              cik VARCHAR, 
-              ticker VARCHAR, 
+              cik VARCHAR,
+              ticker VARCHAR,
               company_name VARCHAR,
-              form VARCHAR, 
-              filing_date DATE, 
-              accession_no VARCHAR,
-              primary_doc VARCHAR, 
-              report_url VARCHAR, 
+              form VARCHAR,
+              filing_date DATE,
+              accession_no VARCHAR PRIMARY KEY,
+              primary_doc VARCHAR,
+              report_url VARCHAR,
               report_text TEXT,
-              summary_ai TEXT, 
-              sentiment VARCHAR, 
+              summary_ai TEXT,
+              sentiment VARCHAR,
               sentiment_score DOUBLE
             );
             """)
-            
+
             self.con.execute("""
             CREATE TABLE IF NOT EXISTS news (
-              ticker VARCHAR, 
-              source VARCHAR, 
+              ticker VARCHAR,
+              source VARCHAR,
               title TEXT,
-              link VARCHAR, 
-              published TIMESTAMP, 
-              summary TEXT, 
+              link VARCHAR PRIMARY KEY,
+              published TIMESTAMP,
+              summary TEXT,
               article_text TEXT,
-              summary_ai TEXT, 
-              sentiment VARCHAR, 
+              summary_ai TEXT,
+              sentiment VARCHAR,
               sentiment_score DOUBLE
             );
             """)
-            
+
+            # Index the hot lookup column so the dashboard's per-ticker
+            # queries don't scan whole tables, and keep a tiny materialized
+            # ticker list so load_ticker_list avoids a UNION+DISTINCT scan.
+            self.con.execute("CREATE INDEX IF NOT EXISTS idx_sec_ticker ON sec_filings(ticker)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS idx_news_ticker ON news(ticker)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS tickers (ticker VARCHAR PRIMARY KEY)")
+
             logger.info("DuckDB tables created successfully")
-            
-            # Test insert
-            self.con.execute("SELECT COUNT(*) FROM sec_filings")
-            self.con.execute("SELECT COUNT(*) FROM news")
-            logger.info("Database connection test successful")
-            
+
+            # Streaming inserts: rows go straight to the DB as items arrive,
+            # with date/score casts done in SQL, so the pipeline keeps no
+            # item buffer and there is no DataFrame/fillna pass at close.
+            # Re-scraped filings/articles are skipped via ON CONFLICT on the
+            # natural keys, but only where the table actually has the
+            # constraint (warehouses created before the PKs were added don't).
+            self._sec_sql = (
+                f"INSERT INTO sec_filings ({', '.join(self.SEC_COLUMNS)}) "
+                "VALUES (?, ?, ?, ?, CAST(? AS DATE), ?, ?, ?, ?, ?, ?, CAST(? AS DOUBLE))"
+                + self._conflict_clause("sec_filings", "accession_no")
+            )
+            self._news_sql = (
+                f"INSERT INTO news ({', '.join(self.NEWS_COLUMNS)}) "
+                "VALUES (?, ?, ?, ?, CAST(? AS TIMESTAMP), ?, ?, ?, ?, CAST(? AS DOUBLE))"
+                + self._conflict_clause("news", "link")
+            )
+            self.sec_count = 0
+            self.news_count = 0
+
         except Exception as e:
             logger.error(f"Failed to setup DuckDB: {e}")
             raise
 
-    def process_item(self, item, spider):
-        logger.info(f"DuckDB Pipeline processing item: {type(item).__name__}")
-        
-        # Convert item to dict and store
-        item_dict = dict(ItemAdapter(item))
-        
-        # Log what we're storing
-        logger.info(f"Item keys: {list(item_dict.keys())}")
-        
-        self.items.append(item_dict)
-        logger.info(f"Total items collected: {len(self.items)}")
-        
-        return item
+    def _conflict_clause(self, table: str, key: str) -> str:
+        has_pk = self.con.execute(
+            "SELECT COUNT(*) FROM duckdb_constraints() "
+            "WHERE table_name = ? AND constraint_type = 'PRIMARY KEY'",
+            [table],
+        ).fetchone()[0]
+        return f" ON CONFLICT ({key}) DO NOTHING" if has_pk else ""
 
-    def close_spider(self, spider):
-        logger.info(f"DuckDB Pipeline closing with {len(self.items)} items")
-        
-        if not self.items:
-            logger.warning("No items to process!")
-            self.con.close()
-            return
+    def process_item(self, item, spider):
+        row = dict(ItemAdapter(item))
+        if "form" in row:  # SEC filing
+            columns, defaults, sql = self.SEC_COLUMNS, self.SEC_DEFAULTS, self._sec_sql
+        else:  # News
+            columns, defaults, sql = self.NEWS_COLUMNS, self.NEWS_DEFAULTS, self._news_sql
 
-        # Separate SEC filings from news
-        sec_items = []
-        news_items = []
-        
-        for item in self.items:
-            if "form" in item:  # SEC filing
-                sec_items.append(item)
-            else:  # News
-                news_items.append(item)
-        
-        logger.info(f"Found {len(sec_items)} SEC filings and {len(news_items)} news items")
-
-        # Process SEC filings
-        if sec_items:
-            try:
-                logger.info("Processing SEC filings...")
-                df = pd.DataFrame(sec_items)
-                
-                # Define expected columns for SEC filings
-                sec_columns = [
-                    "cik", "ticker", "company_name", "form", "filing_date", 
-                    "accession_no", "primary_doc", "report_url", "report_text",
-                    "summary_ai", "sentiment", "sentiment_score"
-                ]
-                
-                # Ensure all columns exist
-                for col in sec_columns:
-                    if col not in df.columns:
-                        df[col] = None
-                
-                df = df[sec_columns]  # Reorder columns
-                
-                # Convert types
-                df["filing_date"] = pd.to_datetime(df["filing_date"], errors="coerce").dt.date
-                df["sentiment_score"] = pd.to_numeric(df["sentiment_score"], errors="coerce")
-                
-                # Fill NaN values
-                df = df.fillna({
-                    'cik': '', 'ticker': '', 'company_name': '', 'form': '',
-                    'accession_no': '', 'primary_doc': '', 'report_url': '', 
-                    'report_text': '', 'summary_ai': '', 'sentiment': 'Unknown',
-                    'sentiment_score': 0.0
-                })
-                
-                logger.info(f"DataFrame shape: {df.shape}")
-                logger.info(f"DataFrame columns: {list(df.columns)}")
-                
-                # Insert into database
-                self.con.register("sec_temp", df)
-                result = self.con.execute("INSERT INTO sec_filings SELECT * FROM sec_temp")
-                
-                # Verify insertion
-                count = self.con.execute("SELECT COUNT(*) FROM sec_filings").fetchone()[0]
-                logger.info(f"Successfully inserted {count} SEC filings")
-                
-            except Exception as e:
-                logger.error(f"Failed to process SEC filings: {e}")
-                logger.error(f"DataFrame info: {df.info() if 'df' in locals() else 'No DataFrame'}")
+        values = [row.get(col) if row.get(col) is not None else defaults.get(col) for col in columns]
+        try:
+            inserted = self.con.execute(sql, values).fetchone()[0]
+            if "form" in row:
+                self.sec_count += inserted
+            else:
+                self.news_count += inserted
+        except Exception as e:
+            logger.error(f"Failed to insert item into DuckDB: {e}")
 
-        # Process news items
-        if news_items:
-            try:
-                logger.info("Processing news items...")
-                df = pd.DataFrame(news_items)
-                
-                # Define expected columns for news (NO report_text!)
-                news_columns = [
-                    "ticker", "source", "title", "link", "published", 
-                    "summary", "article_text", "summary_ai", "sentiment", "sentiment_score"
-                ]
-                
-                # Ensure all columns exist
-                for col in news_columns:
-                    if col not in df.columns:
-                        df[col] = None
-                
-                df = df[news_columns]  # Reorder columns
-                
-                # Convert types
-                df["published"] = pd.to_datetime(df["published"], errors="coerce")
-                df["sentiment_score"] = pd.to_numeric(df["sentiment_score"], errors="coerce")
-                
-                # Fill NaN values
-                df = df.fillna({
-                    'ticker': '', 'source': '', 'title': '', 'link': '',
-                    'summary': '', 'article_text': '', 'summary_ai': '', 
-                    'sentiment': 'Unknown', 'sentiment_score': 0.0
-                })
-                
-                logger.info(f"DataFrame shape: {df.shape}")
-                logger.info(f"DataFrame columns: {list(df.columns)}")
-                
-                # Insert into database
-                self.con.register("news_temp", df)
-                result = self.con.execute("INSERT INTO news SELECT * FROM news_temp")
-                
-                # Verify insertion
-                count = self.con.execute("SELECT COUNT(*) FROM news").fetchone()[0]
-                logger.info(f"Successfully inserted {count} news items")
-                
-            except Exception as e:
-                logger.error(f"Failed to process news items: {e}")
-                logger.error(f"DataFrame info: {df.info() if 'df' in locals() else 'No DataFrame'}")
+        return item
 
-        # Close connection
+    def close_spider(self, spider):
+        logger.info(
+            f"DuckDB Pipeline closing after inserting {self.sec_count} SEC filings "
+            f"and {self.news_count} news items"
+        )
+        try:
+            self.con.execute("""
+            INSERT INTO tickers
+            SELECT DISTINCT UPPER(ticker) FROM (
+                SELECT ticker FROM sec_filings
+                UNION ALL
+                SELECT ticker FROM news
+            )
+            WHERE ticker IS NOT NULL AND ticker <> ''
+            ON CONFLICT DO NOTHING
+            """)
+        except Exception as e:
+            logger.error(f"Failed to refresh tickers table: {e}")
         try:
             self.con.close()
             logger.info("DuckDB connection closed successfully")
@@ -278,40 +359,57 @@ class DuckDBPipeline:
 
 
 class ParquetPipeline:
-    def __init__(self):
-        self.items = []
+    """Dump this run's rows to the Parquet lake straight from DuckDB.
+
+    Items are already streamed into the warehouse by DuckDBPipeline, so
+    there is no need to keep a second copy of every item in Python; we
+    just remember where the table ended before the run and COPY the new
+    rows out with DuckDB's native Parquet writer at close.
+
+    Each spider writes exactly one table, and both spiders run
+    concurrently in one process from the dashboard, so every pipeline
+    instance is scoped to its own spider's table — otherwise one
+    spider's close would dump the other's half-finished rows.
+    """
+
+    SPIDER_TABLES = {"sec_filings": "sec_filings", "yahoo_news_rss": "news"}
 
     def open_spider(self, spider):
         logger.info("Parquet Pipeline opened")
+        # runs after DuckDBPipeline.open_spider, so the tables exist
+        self.con = duckdb.connect(DB_PATH)
+        self.table = self.SPIDER_TABLES.get(spider.name)
+        if self.table is None:
+            logger.warning(f"No lake table mapped for spider {spider.name}; skipping Parquet export")
+            self.start = -1
+        else:
+            self.start = self.con.execute(
+                f"SELECT COALESCE(MAX(rowid), -1) FROM {self.table}"
+            ).fetchone()[0]
 
     def process_item(self, item, spider):
-        logger.info(f"Parquet Pipeline processing item: {type(item).__name__}")
-        self.items.append(dict(ItemAdapter(item)))
         return item
 
     def close_spider(self, spider):
-        logger.info(f"Parquet Pipeline closing with {len(self.items)} items")
-        
-        if not self.items:
-            logger.warning("No items to save to Parquet!")
-            return
-
+        # closes before DuckDBPipeline (reverse pipeline order), with all
+        # of this run's rows already inserted
         ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        
-        # Separate SEC filings from news
-        sec_items = [item for item in self.items if "form" in item]
-        news_items = [item for item in self.items if "form" not in item]
-        
         try:
-            if sec_items:
-                filepath = os.path.join(LAKE_DIR, f"sec_filings_{ts}.parquet")
-                pd.DataFrame(sec_items).to_parquet(filepath)
-                logger.info(f"Saved {len(sec_items)} SEC filings to {filepath}")
-                
-            if news_items:
-                filepath = os.path.join(LAKE_DIR, f"news_{ts}.parquet")
-                pd.DataFrame(news_items).to_parquet(filepath)
-                logger.info(f"Saved {len(news_items)} news items to {filepath}")
-                
+            if self.table is not None:
+                count = self.con.execute(
+                    f"SELECT COUNT(*) FROM {self.table} WHERE rowid > ?", [self.start]
+                ).fetchone()[0]
+                if count:
+                    filepath = os.path.join(LAKE_DIR, f"{self.table}_{ts}.parquet")
+                    self.con.execute(
+                        f"COPY (SELECT * FROM {self.table} WHERE rowid > {self.start}) "
+                        f"TO '{filepath}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+                    )
+                    logger.info(f"Saved {count} {self.table} rows to {filepath}")
         except Exception as e:
-            logger.error(f"Error saving Parquet files: {e}")
\ No newline at end of file
+            logger.error(f"Error saving Parquet files: {e}")
+        finally:
+            try:
+                self.con.close()
+            except Exception as e:
+                logger.error(f"Error closing Parquet pipeline connection: {e}")
\ No newline at end of file
@@ -4,9 +4,19 @@ SPIDER_MODULES = ["stockscraper.spiders"]
 NEWSPIDER_MODULE = "stockscraper.spiders"
 
 ROBOTSTXT_OBEY = True
-DOWNLOAD_DELAY = 0.5
-CONCURRENT_REQUESTS = 8
+# SEC and Yahoo are separate domains: cap per-domain politeness at 8 but let
+# the crawler keep 32 requests in flight overall so the two sites overlap.
+# AutoThrottle raises the delay dynamically, so no static DOWNLOAD_DELAY.
+CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS_PER_DOMAIN = 8
+DOWNLOAD_DELAY = 0
 AUTOTHROTTLE_ENABLED = True
+AUTOTHROTTLE_TARGET_CONCURRENCY = 6.0
+REACTOR_THREADPOOL_MAXSIZE = 20
+DNS_RESOLVER = "scrapy.resolver.CachingThreadedResolver"
+# Prefer requests for domains with free downloader slots when many are queued
+SCHEDULER_PRIORITY_QUEUE = "scrapy.pqueues.DownloaderAwarePriorityQueue"
+TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 
 USER_AGENT = "damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)"
 DEFAULT_REQUEST_HEADERS = {
@@ -1,45 +1,233 @@
 # scraper/stockscraper/spiders/sec_filings.py
+import functools
 import json
+import os
+import pickle
+import time
 import scrapy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from stockscraper.items import SecFilingItem
+from stockscraper.textutils import truncate_words
 
-# FIXED: Proper ticker to CIK conversion
-def to_cik(ticker: str) -> str:
-    """Convert ticker to CIK using SEC's company tickers JSON"""
-    try:
-        # Get the company tickers JSON from SEC
-        headers = {
-            'User-Agent': 'damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)',
-            'Accept': 'application/json'
-        }
-        response = requests.get(
-            'https://www.sec.gov/files/company_tickers.json', 
-            headers=headers,
-            timeout=10
+# selectolax (C-backed Lexbor) extracts text from multi-hundred-KB filings
+# several times faster than building a BeautifulSoup tree
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# orjson parses straight from bytes ~3-5x faster than the stdlib; fall back
+# quietly when it isn't installed (json.loads accepts bytes too)
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# ijson streams just the columns we need out of the multi-MB submissions
+# document instead of materializing all ~20 per-filing arrays
+try:
+    import ijson
+    _PARSE_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    _PARSE_ERRORS = (ValueError,)
+
+_SUBMISSION_PREFIXES = {
+    "filings.recent.form.item": 0,
+    "filings.recent.filingDate.item": 1,
+    "filings.recent.accessionNumber.item": 2,
+    "filings.recent.primaryDocument.item": 3,
+}
+
+def _extract_submissions(body: bytes):
+    """Return (cik, company, forms, dates, accessions, primary_docs).
+
+    Uses incremental parsing when ijson is available so the unused columns
+    of filings.recent (items, size, isXBRL, ...) are never built; otherwise
+    falls back to one full parse.
+    """
+    if ijson is None:
+        data = _json_loads(body)
+        recent = data.get("filings", {}).get("recent", {})
+        return (
+            data.get("cik"), data.get("name"),
+            recent.get("form", []), recent.get("filingDate", []),
+            recent.get("accessionNumber", []), recent.get("primaryDocument", []),
         )
+
+    cik = company = None
+    columns = ([], [], [], [])
+    for prefix, _, value in ijson.parse(body):
+        idx = _SUBMISSION_PREFIXES.get(prefix)
+        if idx is not None:
+            columns[idx].append(value)
+        elif prefix == "cik":
+            cik = value
+        elif prefix == "name":
+            company = value
+    return (cik, company) + columns
+
+# Shared header constants: Scrapy doesn't mutate the dict passed to Request,
+# so every request can reuse the same object instead of rebuilding it.
+SEC_USER_AGENT = 'damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)'
+SEC_JSON_HEADERS = {
+    'User-Agent': SEC_USER_AGENT,
+    'Accept': 'application/json',
+}
+SEC_HTML_HEADERS = {
+    'User-Agent': SEC_USER_AGENT,
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+}
+
+# One pooled session for all direct SEC calls: keep-alive skips repeat TLS
+# handshakes and Accept-Encoding shrinks the multi-MB ticker file ~5x.
+SESSION = requests.Session()
+SESSION.headers.update(SEC_JSON_HEADERS)
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# company_tickers.json is several MB and changes rarely, so it is cached on
+# disk and only revalidated (conditional GET) once the copy is a day old.
+TICKERS_URL = 'https://www.sec.gov/files/company_tickers.json'
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "stockscraper")
+TICKERS_JSON = os.path.join(CACHE_DIR, "company_tickers.json")
+TICKERS_PICKLE = os.path.join(CACHE_DIR, "company_tickers.pkl")
+TICKERS_META = os.path.join(CACHE_DIR, "company_tickers.meta")
+TICKERS_MAX_AGE = 24 * 60 * 60
+
+def _build_ticker_map(companies: dict) -> dict:
+    return {
+        row['ticker'].upper(): str(row['cik_str']).zfill(10)  # Pad to 10 digits
+        for row in companies.values()
+    }
+
+def _load_cached_map() -> dict:
+    try:
+        with open(TICKERS_PICKLE, "rb") as f:
+            return pickle.load(f)
+    except OSError:
+        # pickle missing but the raw JSON may still be there
+        with open(TICKERS_JSON, "rb") as f:
+            return _build_ticker_map(_json_loads(f.read()))
+
+@functools.lru_cache(maxsize=1)
+def _load_ticker_map() -> dict:
+    """Ticker→CIK map from SEC, served from the disk cache when fresh.
+
+    Memoized so spiders spawned per-ticker in one process pay the disk
+    load once; every later to_cik is a plain dict hit.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # fresh pickle: no network round-trip and no JSON parse at all
+    try:
+        if time.time() - os.path.getmtime(TICKERS_PICKLE) < TICKERS_MAX_AGE:
+            with open(TICKERS_PICKLE, "rb") as f:
+                return pickle.load(f)
+    except OSError:
+        pass
+
+    # revalidate with the validators saved from the previous download
+    headers = {}
+    try:
+        with open(TICKERS_META) as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers['If-None-Match'] = meta["etag"]
+        if meta.get("last_modified"):
+            headers['If-Modified-Since'] = meta["last_modified"]
+    except (OSError, ValueError):
+        pass
+
+    try:
+        response = SESSION.get(TICKERS_URL, headers=headers, timeout=10)
+        if response.status_code == 304:
+            # unchanged upstream: reuse the cache and push the next check out 24h
+            os.utime(TICKERS_PICKLE, None)
+            return _load_cached_map()
         response.raise_for_status()
-        
-        companies = response.json()
-        
-        # Search for the ticker
-        for company_data in companies.values():
-            if company_data['ticker'].upper() == ticker.upper():
-                return str(company_data['cik_str']).zfill(10)  # Pad to 10 digits
-        
-        print(f"WARNING: Ticker {ticker} not found in SEC database")
-        return None
-        
+
+        with open(TICKERS_JSON, "wb") as f:
+            f.write(response.content)
+        with open(TICKERS_META, "w") as f:
+            json.dump({
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }, f)
+        mapping = _build_ticker_map(_json_loads(response.content))
+        with open(TICKERS_PICKLE, "wb") as f:
+            pickle.dump(mapping, f)
+        return mapping
+    except Exception as e:
+        print(f"WARNING: Could not refresh company tickers ({e}); using cached copy")
+        return _load_cached_map()
+
+def to_cik(ticker: str) -> str:
+    """Convert ticker to CIK using SEC's company tickers JSON (disk-cached)"""
+    try:
+        cik = _load_ticker_map().get(ticker.upper())
     except Exception as e:
         print(f"ERROR: Failed to convert ticker {ticker} to CIK: {e}")
         return None
 
+    if not cik:
+        print(f"WARNING: Ticker {ticker} not found in SEC database")
+        return None
+    return cik
+
+def _cik_from_cache(ticker: str) -> str:
+    """Resolve a CIK from the local cache only — never touches the network."""
+    try:
+        return _load_cached_map().get(ticker.upper())
+    except OSError:
+        return None
+
+# HTTP cache location must be absolute: when the spiders run in-process from
+# the dashboard there is no scrapy.cfg to infer a project data dir from, and
+# a relative HTTPCACHE_DIR makes FilesystemCacheStorage raise NotConfigured,
+# silently disabling the cache middleware.
+HTTPCACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".scrapy-httpcache"))
+
+# Only these forms feed the dashboard; everything else is skipped in parse.
+_RELEVANT_FORMS = frozenset({"10-K", "10-Q", "8-K"})
+
+# The useful prose of a filing sits at the front of the document; embedded
+# XBRL/base64 payloads behind it can push primary docs to many MB.
+REPORT_HEAD_BYTES = 512 * 1024
+REPORT_WORD_LIMIT = 4000
+
 class SecFilingsSpider(scrapy.Spider):
     name = "sec_filings"
     custom_settings = {
-        "DOWNLOAD_DELAY": 0.5,
-        "USER_AGENT": "damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)"
+        # SEC allows 10 req/s: a fixed 0.5s delay capped us at 2 req/s, so
+        # let AutoThrottle ride up to the limit and back off on 429s instead.
+        "DOWNLOAD_DELAY": 0.1,
+        "AUTOTHROTTLE_ENABLED": True,
+        "AUTOTHROTTLE_TARGET_CONCURRENCY": 8.0,
+        "AUTOTHROTTLE_MAX_DELAY": 5.0,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 10,
+        "USER_AGENT": SEC_USER_AGENT,
+        # Bound per-request memory: the downloader aborts pathological
+        # responses at 8 MB and warns at 2 MB, keeping RSS predictable on
+        # broad multi-ticker crawls. parse_report's head-first extraction
+        # already avoids running selectors over a full oversized body.
+        "DOWNLOAD_MAXSIZE": 8 * 1024 * 1024,
+        "DOWNLOAD_WARNSIZE": 2 * 1024 * 1024,
+        # Submissions JSON and already-fetched filings rarely change, so an
+        # RFC 2616 cache turns warm re-runs into 304s or local disk reads.
+        "HTTPCACHE_ENABLED": True,
+        "HTTPCACHE_POLICY": "scrapy.extensions.httpcache.RFC2616Policy",
+        "HTTPCACHE_STORAGE": "scrapy.extensions.httpcache.FilesystemCacheStorage",
+        "HTTPCACHE_DIR": HTTPCACHE_DIR,
+        "HTTPCACHE_GZIP": True,
     }
 
     def __init__(self, cik=None, ticker=None, *args, **kwargs):
@@ -50,153 +238,169 @@ class SecFilingsSpider(scrapy.Spider):
             self.ticker = ticker or self.cik
         elif ticker:
             self.ticker = ticker.upper()
-            self.cik = to_cik(self.ticker)
-            if not self.cik:
-                raise ValueError(f"Could not find CIK for ticker {self.ticker}")
+            self.cik = None  # resolved in start_requests without blocking __init__
         else:
             raise ValueError("Provide -a cik=... or -a ticker=...")
-        
+
         self.logger.info(f"Initialized SEC spider - Ticker: {self.ticker}, CIK: {self.cik}")
 
     def start_requests(self):
+        if not self.cik:
+            # any cached ticker map resolves locally; only a miss costs a request
+            self.cik = _cik_from_cache(self.ticker)
+
+        if self.cik:
+            yield self._submissions_request()
+        else:
+            self.logger.info(f"Resolving CIK for {self.ticker} via SEC company tickers")
+            yield scrapy.Request(
+                TICKERS_URL,
+                callback=self._resolve_cik,
+                headers=SEC_JSON_HEADERS,
+                dont_filter=True
+            )
+
+    def _submissions_request(self):
         # Use the padded CIK
         url = f"https://data.sec.gov/submissions/CIK{self.cik}.json"
-        
-        headers = {
-            'User-Agent': 'damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)',
-            'Accept': 'application/json'
-        }
-        
+
         self.logger.info(f"Requesting SEC data from: {url}")
-        yield scrapy.Request(
-            url, 
-            callback=self.parse, 
-            headers=headers,
+        return scrapy.Request(
+            url,
+            callback=self.parse,
+            headers=SEC_JSON_HEADERS,
             dont_filter=True
         )
 
-    def parse(self, response):
-        self.logger.info(f"SEC API Response status: {response.status}")
-        self.logger.info(f"Response length: {len(response.text)} characters")
-        
+    def _resolve_cik(self, response):
+        mapping = _build_ticker_map(_json_loads(response.body))
+
+        # refresh the disk cache so future runs skip this request entirely
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(TICKERS_JSON, "wb") as f:
+                f.write(response.body)
+            with open(TICKERS_PICKLE, "wb") as f:
+                pickle.dump(mapping, f)
+        except OSError as e:
+            self.logger.warning(f"Could not write ticker cache: {e}")
+
+        self.cik = mapping.get(self.ticker)
+        if not self.cik:
+            self.logger.error(f"Could not find CIK for ticker {self.ticker}")
+            return
+        yield self._submissions_request()
+
+    async def parse(self, response):
+        # Lazy %-style args: the logger formats only if the record is emitted
+        self.logger.info("SEC API response: status %s, %d bytes", response.status, len(response.body))
+
         if response.status != 200:
-            self.logger.error(f"SEC API returned status {response.status}")
+            self.logger.error("SEC API returned status %s", response.status)
             return
-        
+
         try:
-            data = json.loads(response.text)
-            self.logger.info(f"Successfully parsed JSON response")
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Failed to parse JSON: {e}")
-            self.logger.error(f"Response text: {response.text[:500]}...")
-            return
-        
-        # Log the structure we received
-        cik = data.get("cik")
-        company = data.get("name")
-        
-        self.logger.info(f"Company: {company}")
-        self.logger.info(f"CIK: {cik}")
-        
-        filings = data.get("filings", {})
-        if not filings:
-            self.logger.error("No 'filings' key in response")
+            # stream the raw bytes directly: only the needed columns are built
+            cik, company, forms, dates, accessions, primary_docs = _extract_submissions(response.body)
+        except _PARSE_ERRORS as e:
+            self.logger.error("Failed to parse JSON: %s", e)
+            self.logger.error("Response text: %s...", response.text[:500])
             return
-            
-        recent = filings.get("recent", {})
-        if not recent:
-            self.logger.error("No 'recent' filings found")
+
+        self.logger.info("Company: %s (CIK %s)", company, cik)
+
+        if not forms:
+            self.logger.error("No recent filings found in response")
             return
-        
-        forms = recent.get("form", [])
-        dates = recent.get("filingDate", [])
-        accessions = recent.get("accessionNumber", [])
-        primary_docs = recent.get("primaryDocument", [])
-        
-        self.logger.info(f"Found {len(forms)} total filings")
-        
-        # Log some sample data
-        if forms:
-            self.logger.info(f"Sample forms: {forms[:5]}")
-            self.logger.info(f"Sample dates: {dates[:5]}")
-        
-        relevant_count = 0
-        for i, (form, date, acc, pdoc) in enumerate(zip(forms, dates, accessions, primary_docs)):
-            if form not in ("10-K", "10-Q", "8-K"):
-                continue
-                
-            relevant_count += 1
-            self.logger.info(f"Processing {form} filing from {date}")
-            
-            acc_nodashes = acc.replace("-", "")
-            report_url = f"https://www.sec.gov/Archives/edgar/data/{int(cik)}/{acc_nodashes}/{pdoc}"
-            
-            # Store metadata for the report parsing
-            meta = {
-                "cik": str(cik),
-                "ticker": self.ticker,
-                "company_name": company,
-                "form": form,
-                "filing_date": date,
-                "accession_no": acc,
-                "primary_doc": pdoc,
-                "report_url": report_url,
-            }
-            
-            self.logger.info(f"Following report URL: {report_url}")
-            
+
+        self.logger.info("Found %d total filings; sample forms: %s", len(forms), forms[:5])
+
+        # Filter up front: >95% of rows are irrelevant, so only build row
+        # data (tuples, meta dicts, log strings) for the indices we keep.
+        relevant_idx = [k for k, form in enumerate(forms) if form in _RELEVANT_FORMS]
+
+        # int(cik) strips the zero-padding and is the same for every row,
+        # so build the archives base URL once outside the loop.
+        archives_base = f"https://www.sec.gov/Archives/edgar/data/{int(cik)}/"
+
+        # Filer-level constants live on the spider; Scrapy shallow-copies
+        # meta per request, so keep the per-row dict down to what varies.
+        self._filer_meta = {
+            "cik": str(cik),
+            "ticker": self.ticker,
+            "company_name": company,
+        }
+
+        # response.follow_all can't vary meta per URL (and `yield from` is
+        # not allowed in an async callback), so stream follow() requests
+        # directly; the scheduler consumes the async generator lazily.
+        for k in relevant_idx:
+            form, date, acc, pdoc = forms[k], dates[k], accessions[k], primary_docs[k]
+            # accession numbers hold exactly three dashes: 0000320193-24-000123
+            report_url = f"{archives_base}{acc.replace('-', '', 3)}/{pdoc}"
             yield response.follow(
-                report_url, 
-                self.parse_report, 
-                meta=meta,
-                headers={
-                    'User-Agent': 'damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+                report_url,
+                self.parse_report,
+                meta={
+                    "form": form,
+                    "filing_date": date,
+                    "accession_no": acc,
+                    "primary_doc": pdoc,
+                    "report_url": report_url,
                 },
+                headers=SEC_HTML_HEADERS,
                 dont_filter=True
             )
-        
-        self.logger.info(f"Found {relevant_count} relevant filings (10-K, 10-Q, 8-K)")
-        
-        if relevant_count == 0:
+
+        self.logger.info("Found %d relevant filings (10-K, 10-Q, 8-K)", len(relevant_idx))
+
+        if not relevant_idx:
             self.logger.warning("No relevant filings found!")
 
-    def parse_report(self, response):
-        self.logger.info(f"Parsing report: {response.url}")
-        self.logger.info(f"Report response status: {response.status}")
-        
+    def _extract_text(self, body: bytes) -> str:
+        if HTMLParser is not None:
+            tree = HTMLParser(body)
+            return tree.body.text(separator="\n", strip=True) if tree.body else ""
+        soup = BeautifulSoup(body, "lxml")
+        return soup.get_text(separator="\n", strip=True)
+
+    async def parse_report(self, response):
+        self.logger.debug("Parsing report: %s (status %s)", response.url, response.status)
+
         if response.status != 200:
-            self.logger.error(f"Failed to fetch report: {response.status}")
+            self.logger.error("Failed to fetch report %s: %s", response.url, response.status)
             return
         
         try:
-            # Parse the HTML content
-            soup = BeautifulSoup(response.body, "lxml")
-            report_text = soup.get_text(separator="\n", strip=True)
-            
+            # Parse only the head of the document first; fall back to the full
+            # body when the clipped parse doesn't yield enough words.
+            body = response.body
+            clipped = len(body) > REPORT_HEAD_BYTES
+            report_text = self._extract_text(body[:REPORT_HEAD_BYTES] if clipped else body)
+            truncated_text = truncate_words(report_text, REPORT_WORD_LIMIT)
+            if clipped and truncated_text.count(" ") + 1 < REPORT_WORD_LIMIT:
+                report_text = self._extract_text(body)
+                truncated_text = truncate_words(report_text, REPORT_WORD_LIMIT)
+
             if not report_text:
-                self.logger.warning(f"No text content found in report: {response.url}")
+                self.logger.warning("No text content found in report: %s", response.url)
                 return
-            
-            # Truncate to reasonable size (4000 words)
-            truncated_text = " ".join(report_text.split()[:4000])
-            
-            self.logger.info(f"Extracted {len(report_text)} characters of text (truncated to {len(truncated_text)})")
-            
-            # Get metadata from the request
-            meta_data = response.meta
-            
-            # Create the item
+
+            self.logger.debug("Extracted %d characters of text (truncated to %d)", len(report_text), len(truncated_text))
+
+            # Filer constants come off the spider; meta carries only the
+            # per-filing fields
             item = SecFilingItem()
-            for key, value in meta_data.items():
-                if hasattr(item, key) or key in item.fields:
-                    item[key] = value
-            
+            for source in (self._filer_meta, response.meta):
+                for key, value in source.items():
+                    if key in item.fields:
+                        item[key] = value
+
             item["report_text"] = truncated_text
-            
-            self.logger.info(f"Created SecFilingItem: {item.get('ticker')} - {item.get('form')} - {item.get('filing_date')}")
-            
+
+            self.logger.debug("Created SecFilingItem: %s - %s - %s", item.get('ticker'), item.get('form'), item.get('filing_date'))
+
             yield item
-            
+
         except Exception as e:
-            self.logger.error(f"Error parsing report {response.url}: {e}")
\ No newline at end of file
+            self.logger.error("Error parsing report %s: %s", response.url, e)
\ No newline at end of file
@@ -0,0 +1,14 @@
+# scraper/stockscraper/textutils.py
+import itertools
+import re
+
+_WORD_RE = re.compile(r"\S+")
+
+def truncate_words(text: str, limit: int) -> str:
+    """Return the first `limit` whitespace-separated words of `text`.
+
+    Streams matches with a compiled regex instead of text.split()[:limit],
+    so a 100k+-word filing never materializes a full word list just to
+    keep the first few thousand entries.
+    """
+    return " ".join(m.group(0) for m in itertools.islice(_WORD_RE.finditer(text), limit))
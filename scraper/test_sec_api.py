@@ -1,23 +1,19 @@
 #!/usr/bin/env python3
 # test_sec_api.py - Test SEC API connection
-import requests
 import json
 
+# shared pooled session (keep-alive + gzip + retries) from the SEC spider
+from stockscraper.spiders.sec_fillings import SESSION
+
 def test_sec_api():
     print("🔍 Testing SEC API Connection")
     print("=" * 50)
-    
+
     # Test 1: Get company tickers
     print("1. Testing company tickers endpoint...")
     try:
-        headers = {
-            'User-Agent': 'damian-uni-project/1.0 (contact: damian.liew@u.nus.edu)',
-            'Accept': 'application/json'
-        }
-        
-        response = requests.get(
-            'https://www.sec.gov/files/company_tickers.json', 
-            headers=headers,
+        response = SESSION.get(
+            'https://www.sec.gov/files/company_tickers.json',
             timeout=10
         )
         response.raise_for_status()
@@ -47,7 +43,7 @@ def test_sec_api():
         url = f"https://data.sec.gov/submissions/CIK{aapl_cik}.json"
         print(f"URL: {url}")
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.get(url, timeout=10)
         response.raise_for_status()
         
         data = response.json()
@@ -66,16 +62,17 @@ def test_sec_api():
         relevant_forms = [f for f in forms if f in ("10-K", "10-Q", "8-K")]
         print(f"Relevant filings (10-K, 10-Q, 8-K): {len(relevant_forms)}")
         
-        # Show recent relevant filings
+        # Show recent relevant filings, keeping each row's index so the
+        # sample-report step below can address the parallel arrays directly
         recent_relevant = []
         for i, (form, date) in enumerate(zip(forms, dates)):
             if form in ("10-K", "10-Q", "8-K"):
-                recent_relevant.append((form, date))
+                recent_relevant.append((i, form, date))
             if len(recent_relevant) >= 5:
                 break
-        
+
         print("Recent relevant filings:")
-        for form, date in recent_relevant:
+        for _, form, date in recent_relevant:
             print(f"  - {form} on {date}")
         
         if len(relevant_forms) == 0:
@@ -91,9 +88,7 @@ def test_sec_api():
     print(f"\n3. Testing sample report access...")
     try:
         if recent_relevant:
-            form, date = recent_relevant[0]
-            # Find the corresponding accession and primary doc
-            form_index = forms.index(form)
+            form_index, form, date = recent_relevant[0]
             accession = filings.get("accessionNumber", [])[form_index]
             primary_doc = filings.get("primaryDocument", [])[form_index]
             
@@ -102,7 +97,7 @@ def test_sec_api():
             
             print(f"Testing report URL: {report_url}")
             
-            response = requests.head(report_url, headers=headers, timeout=10)  # Use HEAD to check if accessible
+            response = SESSION.head(report_url, timeout=10)  # Use HEAD to check if accessible
             
             if response.status_code == 200:
                 print("✅ Report URL is accessible")